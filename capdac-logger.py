@@ -1,8 +1,12 @@
+import csv
+import io
+import json
+import os
 import pathlib
 import sys
 import time
 
-import pandas as pd
+import numpy as np
 import serial
 
 # --------------------------------------------------------------------------------------------------------------------
@@ -19,12 +23,22 @@ baudRate_serial = 115200  # Measure of data speed
 timeout_serial = 2  # in seconds  # Number of seconds to wait for serial data
 
 DataFileName = "myFile"
+OUTPUT_FORMAT = "feather"  # Output file format: "feather" (with a JSON metadata file) or "csv"
 
 # --------------------------------------------------------------------------------------------------------------------
 # Private Constants
 # --------------------------------------------------------------------------------------------------------------------
 _CAP_SENSOR_SAMPLING_RATE = 80  # in Hz (this must match the TIME_INTERVAL variable in the ESP32 code)
 
+# Layout of one sample sent by the ESP32 (matches the cap_sens_reading struct in the ESP32 code, little-endian)
+_ESP32_SAMPLE_DTYPE = np.dtype([("ts", "<u4"), ("cap", "<i4")])
+
+# Output file formats supported by save_data
+_OUTPUT_FORMATS = ("feather", "csv")
+
+# Receive buffer reused across serial reads (only reallocated when a larger read is requested)
+_RX_BUF = bytearray()
+
 
 # --------------------------------------------------------------------------------------------------------------------
 # Functions
@@ -39,25 +53,47 @@ def enhancedReadSerial(serialPort: serial, nBytes, timeout=40):
         timeout: Number of attempts before timing out.
 
     Returns:
-        A bytearray containing the received data.
+        A memoryview of the received data. It shares the module receive buffer, so it is only valid
+        until the next call.
     """
-    buf = bytearray()
+    global _RX_BUF
+    if len(_RX_BUF) < nBytes:
+        _RX_BUF = bytearray(nBytes)
+
+    view = memoryview(_RX_BUF)[:nBytes]
+    pos = 0
     cont = 0
 
-    while True:
-        # Read available bytes (at least 1, at most nBytes)
-        ii = max(1, min(nBytes, serialPort.in_waiting))
-        data = serialPort.read(ii)
-        if not data:
-            cont += 1
-            if cont == timeout:
-                print("Error: timeout in enhanced read serial")
-                sys.exit(1)
-        else:
-            buf.extend(data)
+    # The ESP32 streams samples in real time, so a payload takes as long to arrive as it took to acquire. If that is
+    # longer than the port timeout, raise the timeout so the first read can wait for the whole payload (setting the
+    # timeout reconfigures the port, so short reads such as acknowledgments keep the current one)
+    portTimeout = serialPort.timeout
+    streamTime = nBytes / (_ESP32_SAMPLE_DTYPE.itemsize * _CAP_SENSOR_SAMPLING_RATE)
+    if streamTime > portTimeout:
+        serialPort.timeout = streamTime + timeout_serial
 
-        if len(buf) >= nBytes:
-            return buf
+    try:
+        while pos < nBytes:
+            # Block until the remaining bytes arrive or the port timeout expires. The receive buffer is never resized,
+            # but pyserial's readinto is read() followed by a copy into the buffer, so each read still allocates
+            nRead = serialPort.readinto(view[pos:])
+
+            # Retries after a short read use the port timeout, so a missing tail does not wait the whole stream again
+            if serialPort.timeout != portTimeout:
+                serialPort.timeout = portTimeout
+
+            if not nRead:
+                cont += 1
+                if cont == timeout:
+                    print("Error: timeout in enhanced read serial")
+                    sys.exit(1)
+            else:
+                pos += nRead
+    finally:
+        if serialPort.timeout != portTimeout:
+            serialPort.timeout = portTimeout
+
+    return view
 
 
 # def _getDevAck(serialPort: serial, comm2send, comm2rec, timeout=40):
@@ -122,16 +158,20 @@ def getDevAck(serialPort: serial, comm2send, comm2rec, timeout=40):
 
     Args:
         serialPort: The serial port object.
-        comm2send: The command to send (string or convertible to string).
+        comm2send: The command to send (bytes, string or integer).
         comm2rec: The expected acknowledgment byte.
         timeout: Number of attempts before timing out.
     """
-    if not isinstance(comm2send, str):
-        comm2send = str(comm2send)
-
-    esp32Timeout = 0  # Counter for timeout attempts
+    # The ESP32 parses commands as ASCII text, so integers are sent as their decimal digits
+    if isinstance(comm2send, bytes):
+        payload = comm2send
+    elif isinstance(comm2send, str):
+        payload = comm2send.encode("ascii")
+    else:
+        payload = b"%d" % comm2send
 
     echo_command = comm2rec.to_bytes(1, "big")
+    expected_response = b"\x3C" + echo_command + b"\x3E"
 
     # print(echo_command)
 
@@ -141,38 +181,27 @@ def getDevAck(serialPort: serial, comm2send, comm2rec, timeout=40):
     # Send the expected acknowledgment code to ESP32
     serialPort.write(echo_command)
 
-    while esp32Timeout <= 20:
-        response = enhancedReadSerial(serialPort, 3) # Response is 3 bytes
-        if len(response) == 3 and response == bytearray(b'\x3C' + echo_command + b'\x3E'):
+    # Wait for the ESP32 to echo the command code (blocks until the response arrives)
+    for _ in range(timeout):
+        response = enhancedReadSerial(serialPort, 3)  # Response is 3 bytes
+        if response == expected_response:
             # print(response)
             break
-        else:
-            esp32Timeout += 1
-
-        if esp32Timeout == timeout:
-            print("\nError (ESP32 Communication): Timeout when communicating with the device \n")
-            sys.exit(1)  # stop program execution if error found
-        time.sleep(0.5)
+    else:
+        print("\nError (ESP32 Communication): Timeout when communicating with the device \n")
+        sys.exit(1)  # stop program execution if error found
 
     # Send the actual command to ESP32
-    serialPort.write(comm2send.encode("utf-8"))
-
-    # Wait for 'O' (OK) response from ESP32
-    while esp32Timeout <= 20:
-        if serialPort.in_waiting > 0:
-            x = serialPort.read().decode("utf-8")
-            if x == "O":
-                esp32Timeout = 0
-                break
-            else:
-                print("\nError (ESP32 Communication): Failed to receive 'O' command from the device \n")
-                sys.exit(1)  # stop program execution if error found
+    serialPort.write(payload)
 
-        esp32Timeout += 1
-        if esp32Timeout == timeout:
-            print("\nError (ESP32 Communication): Timeout when communicating with the device \n")
-            sys.exit(1)  # stop program execution if error found
-        time.sleep(0.5)
+    # Wait for 'O' (OK) response from ESP32 (blocks for up to the port timeout)
+    x = serialPort.read(1)
+    if not x:
+        print("\nError (ESP32 Communication): Timeout when communicating with the device \n")
+        sys.exit(1)  # stop program execution if error found
+    if x != b"O":
+        print("\nError (ESP32 Communication): Failed to receive 'O' command from the device \n")
+        sys.exit(1)  # stop program execution if error found
 
 
 def build_data_headers(headers: dict, custom_metadata: dict = None) -> dict:
@@ -192,16 +221,83 @@ def build_data_headers(headers: dict, custom_metadata: dict = None) -> dict:
     header_spacing = 1  # spacing between metadata and headers
 
     # Determine the maximum metadata length
-    max_meta_len = max([len(v) for v in custom_metadata.values()], default=0) + header_spacing
+    max_meta_len = max((len(v) for v in custom_metadata.values()), default=0) + header_spacing
+
+    # Pad the metadata of each column (columns without metadata get only padding) and append the header
+    return {
+        col: (meta := custom_metadata.get(col, [])) + [None] * (max_meta_len - len(meta)) + [header]
+        for col, header in headers.items()
+    }
+
+
+def convert_capacitance(rawData: np.ndarray, capdac: int) -> np.ndarray:
+    """
+    Converts raw FDC1004 measurements to capacitance values (in pF).
+
+    Args:
+        rawData: The raw measurements sent by the ESP32.
+        capdac: The CAPDAC value used during the measurements.
+
+    Returns:
+        A float64 array with the capacitance values (float32 cannot resolve one raw count above ~32 pF).
+    """
+    # Formula from FDC1004 datasheet (page 16): raw / 2^19 + CAPDAC * 3.125, with the CAPDAC offset folded into a
+    # single constant and the scaling done as an exact multiplication by 2^-19
+    offset = capdac * 3.125
+    capData = rawData * (1 / 524288.0)
+    capData += offset
 
-    # Pad default metadata
-    padded_default_metadata = [None] * (max_meta_len)
+    return capData
 
-    # Pad all custom metadata entries
-    padded_custom_metadata = {col: meta + [None] * (max_meta_len - len(meta)) for col, meta in custom_metadata.items()}
 
-    # Build the final dictionary
-    return {col: padded_custom_metadata.get(col, padded_default_metadata) + [header] for col, header in headers.items()}
+def save_data(dataFolderPath: pathlib.Path, fileName: str, headers: dict, metadata: dict, body: dict):
+    """
+    Saves the acquired data in the format selected by OUTPUT_FORMAT.
+
+    Args:
+        dataFolderPath: Path of the folder where the data is saved.
+        fileName: Name of the output file, without extension.
+        headers: A dictionary where keys are column letters and values are header names.
+        metadata: A dictionary with the metadata lists for certain columns. The labels are in column "A" and their
+            values in column "B" (other columns are only written to the CSV header).
+        body: A dictionary where keys are column letters and values are the data arrays.
+    """
+    if OUTPUT_FORMAT == "csv":
+        # Build the full header section with metadata
+        dataHeaders = build_data_headers(headers, metadata)
+
+        # Format the metadata, headers and data in memory
+        csvText = io.StringIO()
+        csv.writer(csvText, lineterminator=os.linesep).writerows(zip(*dataHeaders.values()))
+        np.savetxt(csvText, np.column_stack(list(body.values())), fmt=["%d", "%d", "%.4f"], delimiter=",", newline=os.linesep)
+        csvBytes = memoryview(csvText.getvalue().encode("utf-8"))
+
+        # Save them to a CSV file, bypassing Python's buffered file objects (a single write unless the OS splits it)
+        fd = os.open(
+            dataFolderPath.joinpath(fileName + ".csv"),
+            os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0),
+            0o666,
+        )
+        try:
+            while csvBytes:
+                csvBytes = csvBytes[os.write(fd, csvBytes) :]
+        finally:
+            os.close(fd)
+    elif OUTPUT_FORMAT == "feather":
+        # Imported here so the pyarrow import time is not spent before communicating with the ESP32
+        import pyarrow as pa
+        from pyarrow import feather
+
+        # Save the data to a Feather file, keeping the column dtypes
+        capacitanceData_table = pa.table({headers[col]: data for col, data in body.items()})
+        feather.write_feather(capacitanceData_table, dataFolderPath.joinpath(fileName + ".feather"), compression="zstd")
+
+        # Save the metadata next to the data file
+        with open(dataFolderPath.joinpath(fileName + ".json"), "w") as metadataFile:
+            json.dump({label.rstrip(":"): value for label, value in zip(metadata["A"], metadata["B"])}, metadataFile, indent=4)
+    else:
+        print(f"\nError (Saving Data): Unknown OUTPUT_FORMAT {OUTPUT_FORMAT!r}, use one of {', '.join(_OUTPUT_FORMATS)} \n")
+        sys.exit(1)  # stop program execution if error found
 
 
 if __name__ == "__main__":
@@ -212,6 +308,11 @@ if __name__ == "__main__":
     # 4 bytes for timestamp and 4 bytes for capacitive sensor data
     nBytes_to_receive = 8
 
+    # Check the output format before acquiring data, so an invalid value does not discard an acquisition
+    if OUTPUT_FORMAT not in _OUTPUT_FORMATS:
+        print(f"\nError (Saving Data): Unknown OUTPUT_FORMAT {OUTPUT_FORMAT!r}, use one of {', '.join(_OUTPUT_FORMATS)} \n")
+        sys.exit(1)  # Exit the program if the output format is not supported
+
     # Initialize serial communication with the ESP32
     try:
         # If a port is specified, the serial connection opens automatically
@@ -220,6 +321,15 @@ if __name__ == "__main__":
         print("\nError (Serial Communication): Check the communication port \n")
         sys.exit(1)  # Exit the program if the serial connection fails
 
+    # Where supported (Linux serial drivers), set the ASYNC_LOW_LATENCY flag so received bytes reach the blocking reads
+    # without driver buffering delays. pyserial only provides this on POSIX ports and raises NotImplementedError on
+    # platforms other than Linux
+    if hasattr(serialPort, "set_low_latency_mode"):
+        try:
+            serialPort.set_low_latency_mode(True)
+        except (ValueError, NotImplementedError):
+            pass  # Low latency mode is not supported by this platform or serial driver
+
     # Ensure CAPDAC value is within the valid range [0, 31]
     CAPDAC = max(0, min(31, CAPDAC))
 
@@ -237,7 +347,7 @@ if __name__ == "__main__":
     print("now...")
 
     # Send the start signal to begin data acquisition
-    getDevAck(serialPort, "S", 2)
+    getDevAck(serialPort, b"S", 2)
 
     # Read the expected number of bytes from the serial port
     serialData = enhancedReadSerial(serialPort, sampsToGet * nBytes_to_receive)
@@ -251,23 +361,15 @@ if __name__ == "__main__":
 
 
 
-    # Split the raw data into timestamp and capacitive sensor byte pairs
-    pairs = [(elements[:4], elements[4:]) for elements in [serialData[ii : ii + nBytes_to_receive] for ii in range(0, len(serialData), nBytes_to_receive)]]
-
-    esp32_timestamp_bytes = []
-    cap_sensor_bytes = []
-
-    for x, y in pairs:
-        esp32_timestamp_bytes.append(x)
-        cap_sensor_bytes.append(y)
+    # View the raw data as timestamp and capacitive sensor columns without copying it,
+    # discarding any trailing partial sample
+    samples = np.frombuffer(serialData, dtype=_ESP32_SAMPLE_DTYPE, count=len(serialData) // nBytes_to_receive)
 
-    # Convert capacitive sensor bytes to capacitance values (in pF)
-    # Formula from FDC1004 datasheet (page 16), using little-endian byte order as that is the format from the ESP32
-    capData = [round(((int.from_bytes(bytes_data, byteorder="little", signed=True) / 524288.0) + (CAPDAC * 3.125)), 4) for bytes_data in cap_sensor_bytes]
+    # Convert capacitive sensor data to capacitance values (in pF)
+    capData = convert_capacitance(samples["cap"], CAPDAC)
 
-    # Convert timestamp bytes to relative time (in microseconds)
-    _esp32_timestamp = [int.from_bytes(bytes_data, byteorder="little") for bytes_data in esp32_timestamp_bytes]
-    esp32_timestamp = [x - _esp32_timestamp[0] for x in _esp32_timestamp]
+    # Convert timestamps to relative time (in microseconds), widening to int64 in the same pass
+    esp32_timestamp = np.subtract(samples["ts"], samples["ts"][0], dtype=np.int64)
 
     # Close the serial port after data acquisition
     serialPort.close()
@@ -281,7 +383,7 @@ if __name__ == "__main__":
         dataFolderNamePath.mkdir()
 
     # Generate sample numbers for each data point
-    cap_data_num_samples = list(range(1, len(esp32_timestamp) + 1))
+    cap_data_num_samples = np.arange(1, len(esp32_timestamp) + 1, dtype=np.int32)
 
     # Define column headers for the CSV file
     _dataHeaders = {
@@ -303,21 +405,7 @@ if __name__ == "__main__":
         "C": capData,
     }
 
-    # Build the full header section with metadata
-    dataHeaders = build_data_headers(_dataHeaders, dataMetadata)
-
-    # Create DataFrames for headers and data
-    header_df = pd.DataFrame(dataHeaders)
-    dataBody_df = pd.DataFrame(dataBody)
-
-    # Combine header and data into a single DataFrame
-    capacitanceData_df = pd.concat([header_df, dataBody_df], ignore_index=True)
-
-    # Save the DataFrame to a CSV file
-    capacitanceData_df.to_csv(
-        dataFolderNamePath.joinpath(DataFileName + ".csv"),
-        index=False,
-        header=False,
-    )
+    # Save the data
+    save_data(dataFolderNamePath, DataFileName, _dataHeaders, dataMetadata, dataBody)
 
     print(f"\nDone saving data")